@@ -2,6 +2,7 @@
 
 import configparser
 import json
+import math
 import time
 from enum import Enum
 
@@ -9,6 +10,7 @@ import boto3
 import redshift_connector
 from redshift_connector.core import Connection, Cursor
 
+from queries import bump_table_version
 from sql_statements import *
 
 
@@ -21,6 +23,15 @@ class ClusterStatus(Enum):
     CREATING = 5
 
 
+# Capacity and on-demand price (us-west-2) of the node types the sizing step knows about
+# storage_gb is the local SSD storage per node, slices the parallel COPY units per node,
+# half_or_double_only marks node types whose elastic resize can only halve or double the node count
+NODE_TYPES = {
+    "dc2.large": {"storage_gb": 160, "slices": 2, "hourly_cost": 0.25, "half_or_double_only": True},
+    "dc2.8xlarge": {"storage_gb": 2560, "slices": 16, "hourly_cost": 4.80, "half_or_double_only": False},
+}
+
+
 # Don't use access keys - just configure local .aws environment instead
 ec2 = boto3.resource('ec2',
                      region_name="us-west-2"
@@ -129,6 +140,226 @@ def get_configs() -> configparser.ConfigParser:
     return config
 
 
+# Sizing routines
+
+def measure_s3_prefix(s3_uri: str) -> (int, int):
+    """
+    Count the objects and bytes under an s3 prefix such as s3://udacity-dend/song_data
+
+    :param s3_uri: the s3 uri of the prefix
+    :return: the number of objects and their total size in bytes
+    """
+    bucket_name, _, prefix = s3_uri.replace("s3://", "", 1).partition("/")
+    object_count, total_bytes = 0, 0
+    for obj in s3.Bucket(bucket_name).objects.filter(Prefix=prefix):
+        object_count += 1
+        total_bytes += obj.size
+    return object_count, total_bytes
+
+
+def measure_load_input(configs: configparser.ConfigParser) -> (int, int):
+    """
+    Measure the song and log data we are about to COPY into the staging tables
+
+    :param configs: configurations
+    :return: the number of objects and their total size in bytes
+    """
+    object_count, total_bytes = 0, 0
+    for key in ("SONG_DATA", "LOG_DATA"):
+        prefix = configs.get("S3", key)
+        objects, size = measure_s3_prefix(prefix)
+        print(f"{prefix}: {objects} objects, {size / 1024 ** 2:.1f} MB")
+        object_count += objects
+        total_bytes += size
+    return object_count, total_bytes
+
+
+def estimate_cluster_size(configs: configparser.ConfigParser, object_count: int, total_bytes: int) -> (str, int):
+    """
+    Pick the cheapest node type and count that can hold and load the input in the target time.
+
+    Storage: the raw json is compressed by SIZING.COMPRESSION_RATIO once columnar, and we keep
+    SIZING.STORAGE_HEADROOM times that for the staging copy, the star schema and sorting.
+    Throughput: every slice COPYs SIZING.SLICE_MB_PER_SEC and pays SIZING.FILE_OVERHEAD_SEC per file,
+    and we want enough slices to finish within SIZING.TARGET_LOAD_MINUTES.
+    Cost: the hourly price of the whole cluster, which keeps running after the load.
+
+    :param configs: configurations
+    :param object_count: number of input objects
+    :param total_bytes: total size of the input objects
+    :return: the node type and number of nodes
+    """
+    min_nodes = configs.getint("SIZING", "MIN_NODES")
+    max_nodes = configs.getint("SIZING", "MAX_NODES")
+    compressed_gb = total_bytes / configs.getfloat("SIZING", "COMPRESSION_RATIO") / 1024 ** 3
+    required_gb = compressed_gb * configs.getfloat("SIZING", "STORAGE_HEADROOM")
+    load_seconds = (total_bytes / 1024 ** 2 / configs.getfloat("SIZING", "SLICE_MB_PER_SEC")
+                    + object_count * configs.getfloat("SIZING", "FILE_OVERHEAD_SEC"))
+    target_seconds = configs.getfloat("SIZING", "TARGET_LOAD_MINUTES") * 60
+    required_slices = math.ceil(load_seconds / target_seconds)
+
+    node_types = []
+    for node_type in [t.strip() for t in configs.get("SIZING", "NODE_TYPES").split(",")]:
+        if node_type in NODE_TYPES:
+            node_types.append(node_type)
+        else:
+            print(f"Unknown node type {node_type} in SIZING.NODE_TYPES, skipping it ...")
+
+    best = None
+    for node_type in node_types:
+        spec = NODE_TYPES[node_type]
+        num_nodes = max(min_nodes,
+                        math.ceil(required_gb / spec["storage_gb"]),
+                        math.ceil(required_slices / spec["slices"]))
+        if num_nodes > max_nodes:
+            continue
+
+        cost = num_nodes * spec["hourly_cost"]
+        if best is None or cost < best[0]:
+            best = (cost, node_type, num_nodes)
+
+    if best is None:
+        # nothing fits the target time, so load with as many slices as we are allowed
+        node_type = max(node_types, key=lambda t: NODE_TYPES[t]["slices"])
+        print(f"Input needs more than {max_nodes} nodes, using {max_nodes} x {node_type} ...")
+        return node_type, max_nodes
+
+    return best[1], best[2]
+
+
+def size_cluster(configs: configparser.ConfigParser) -> (str, int):
+    """
+    Measure the s3 input and record the node type and count to load it with as
+    DWH_LOAD_NODE_TYPE and DWH_LOAD_NUM_NODES.
+    DWH_NODE_TYPE and DWH_NUM_NODES stay the size we scale back down to after loading,
+    and we never load on a smaller cluster than that.
+
+    :param configs: configurations
+    :return: the node type and number of nodes for the load
+    """
+    node_type = configs.get("DWH", "DWH_NODE_TYPE")
+    num_nodes = configs.getint("DWH", "DWH_NUM_NODES")
+
+    if configs.getboolean("SIZING", "ENABLED", fallback=False):
+        if node_type not in NODE_TYPES:
+            print(f"No sizing data for DWH_NODE_TYPE {node_type}, using the configured size ...")
+        else:
+            print("Sizing cluster from s3 input ...")
+            object_count, total_bytes = measure_load_input(configs)
+            load_node_type, load_num_nodes = estimate_cluster_size(configs, object_count, total_bytes)
+
+            # only grow for the load: an estimate without more slices or storage than the configured size is no gain
+            load_spec, spec = NODE_TYPES[load_node_type], NODE_TYPES[node_type]
+            if (load_num_nodes * load_spec["slices"] > num_nodes * spec["slices"]
+                    or load_num_nodes * load_spec["storage_gb"] > num_nodes * spec["storage_gb"]):
+                node_type, num_nodes = load_node_type, load_num_nodes
+        print(f"Load cluster size: {num_nodes} x {node_type}")
+
+    configs.set("DWH", "DWH_LOAD_NODE_TYPE", node_type)
+    configs.set("DWH", "DWH_LOAD_NUM_NODES", str(num_nodes))
+    return node_type, num_nodes
+
+
+def elastic_node_counts(node_type: str, num_nodes: int) -> list:
+    """
+    The node counts an elastic resize can take a cluster of this node type and size to
+
+    :param node_type: the node type of the cluster
+    :param num_nodes: the current number of nodes
+    :return: the possible node counts, smallest first
+    """
+    if NODE_TYPES.get(node_type, {}).get("half_or_double_only", True):
+        return ([num_nodes // 2] if num_nodes % 2 == 0 and num_nodes >= 4 else []) + [num_nodes * 2]
+    return list(range(max(2, math.ceil(num_nodes / 2)), num_nodes * 2 + 1))
+
+
+def resize_cluster(configs: configparser.ConfigParser, node_type: str, num_nodes: int, allow_classic: bool = False):
+    """
+    Resize the Redshift cluster and wait until it is available at the new size.
+
+    Elastic resize keeps the node type and only reaches some node counts (see elastic_node_counts()).
+    Without allow_classic we stay elastic: the node type is kept, and the count becomes the smallest
+    reachable one with at least the requested slices, or the largest reachable one.
+    With allow_classic a size elastic resize cannot reach takes a (much slower) classic resize,
+    during which the cluster is read-only.
+
+    Raises if Redshift refuses the resize, or the cluster is not at the new size within
+    SIZING.RESIZE_TIMEOUT_MINUTES, rather than carrying on at the old size.
+
+    :param configs: configurations
+    :param node_type: the node type to resize to
+    :param num_nodes: the number of nodes to resize to
+    :param allow_classic: whether a classic resize may be used
+    """
+    cluster_status, props = check_cluster_available(configs)
+    if cluster_status != ClusterStatus.AVAILABLE:
+        return
+
+    current_type, current_nodes = props['NodeType'], props['NumberOfNodes']
+    if current_type == node_type and current_nodes == num_nodes:
+        return
+
+    reachable = elastic_node_counts(current_type, current_nodes)
+    classic = current_type != node_type or num_nodes not in reachable
+    if classic and not allow_classic:
+        if current_type != node_type:
+            print(f"Node type changes only at create time, keeping {current_type} ...")
+            wanted_slices = num_nodes * NODE_TYPES[node_type]["slices"]
+            num_nodes = math.ceil(wanted_slices / NODE_TYPES.get(current_type, {"slices": 1})["slices"])
+            node_type = current_type
+        num_nodes = next((n for n in reachable if n >= num_nodes), reachable[-1])
+        classic = False
+        if num_nodes == current_nodes:
+            return
+
+    print(f"{'Classic' if classic else 'Elastic'} resize cluster from {current_nodes} x {current_type} "
+          f"to {num_nodes} x {node_type} ...")
+
+    cluster_name = configs.get("DWH", "DWH_CLUSTER_IDENTIFIER")
+    redshift.resize_cluster(ClusterIdentifier=cluster_name,
+                            ClusterType=configs.get("DWH", "DWH_CLUSTER_TYPE"),
+                            NodeType=node_type,
+                            NumberOfNodes=num_nodes,
+                            Classic=classic)
+
+    # the status can still read 'available' right after the request, so also wait for the new size
+    deadline = time.time() + configs.getfloat("SIZING", "RESIZE_TIMEOUT_MINUTES", fallback=120) * 60
+    while True:
+        cluster_status, props = check_cluster_available(configs)
+        if (cluster_status == ClusterStatus.AVAILABLE
+                and props['NodeType'] == node_type and props['NumberOfNodes'] == num_nodes):
+            break
+        if time.time() > deadline:
+            raise TimeoutError(f"Cluster {cluster_name} did not reach {num_nodes} x {node_type}, "
+                               f"it is {props['NumberOfNodes']} x {props['NodeType']}")
+        print("waiting 30 sec for resize....")
+        time.sleep(30)
+
+
+def scale_cluster_up(configs: configparser.ConfigParser):
+    """
+    Elastic resize the cluster towards the load size chosen by size_cluster()
+
+    :param configs: configurations
+    """
+    resize_cluster(configs,
+                   configs.get("DWH", "DWH_LOAD_NODE_TYPE"),
+                   configs.getint("DWH", "DWH_LOAD_NUM_NODES"))
+
+
+def scale_cluster_down(configs: configparser.ConfigParser):
+    """
+    Resize the cluster back to the configured DWH_NODE_TYPE and DWH_NUM_NODES.
+    The load is done by now, so this may take a classic resize, e.g. from a larger node type.
+
+    :param configs: configurations
+    """
+    resize_cluster(configs,
+                   configs.get("DWH", "DWH_NODE_TYPE"),
+                   configs.getint("DWH", "DWH_NUM_NODES"),
+                   allow_classic=True)
+
+
 # Main routines
 
 def create_role_arn(configs: configparser.ConfigParser) -> str:
@@ -193,8 +424,8 @@ def redshift_cluster_up(configs: configparser.ConfigParser) -> (ClusterStatus, d
             response = redshift.create_cluster(
                 # HW
                 ClusterType=configs.get("DWH", "DWH_CLUSTER_TYPE"),
-                NodeType=configs.get("DWH", "DWH_NODE_TYPE"),
-                NumberOfNodes=int(configs.get("DWH", "DWH_NUM_NODES")),
+                NodeType=configs.get("DWH", "DWH_LOAD_NODE_TYPE", fallback=configs.get("DWH", "DWH_NODE_TYPE")),
+                NumberOfNodes=int(configs.get("DWH", "DWH_LOAD_NUM_NODES", fallback=configs.get("DWH", "DWH_NUM_NODES"))),
 
                 # Identifiers & Credentials
                 DBName=configs.get("DWH", "DWH_DB"),
@@ -278,7 +509,8 @@ def create_schemas(conn: Connection):
 
 def drop_tables(conn: Connection, cur: Cursor):
     """
-    Drop all tables using the sql in the global drop_table_queries variable
+    Drop all tables using the sql in the global drop_table_queries variable,
+    and invalidate the cached query results that read them
 
     :param conn: Redshift connection
     :param cur: Redshift cursor
@@ -288,6 +520,9 @@ def drop_tables(conn: Connection, cur: Cursor):
         cur.execute(query)
         conn.commit()
 
+    for table in all_tables:
+        bump_table_version(table)
+
 
 def create_tables(cur: Cursor, conn: Connection):
     """
@@ -316,8 +551,12 @@ def init_database() -> (Connection, configparser.ConfigParser):
     # create s3 access role
     role_arn = create_role_arn(configs=config)
 
-    # create cluster
+    # pick the cluster size from the data we are about to load
+    size_cluster(config)
+
+    # create cluster, or resize an existing one up for the load
     redshift_cluster_up(config)
+    scale_cluster_up(config)
 
     # connect to cluster
     conn = connect_redshift(config)
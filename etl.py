@@ -2,8 +2,8 @@
 
 import time
 
-from create_tables import init_database, redshift_cluster_down
-from queries import perform_queries
+from create_tables import init_database, redshift_cluster_down, scale_cluster_down
+from queries import bump_table_version, perform_queries, profile_tables
 from sql_statements import *
 
 """
@@ -88,12 +88,14 @@ def load_one_staging_table(conn, table, prefix, credentials, json="auto"):
     ts2 = time.time() - ts1
     print(f"Completed {table} took {ts2} milliseconds ...\n-------------------\n")
     conn.commit()
+    bump_table_version(table)
 
 
 def insert_tables(conn):
     """
     Insert data from the staging tables (songs, logs) into the Star schema.
     The SQL statements are all constants in the sql_statements.py file
+    Each loaded table gets a new version, which invalidates cached query results that read it
 
     :param conn: the Redshift connector
 
@@ -117,13 +119,19 @@ def insert_tables(conn):
 
     conn.commit()
 
+    # invalidate cached query results once the new data is visible
+    for table in [DIM_SONG_TABLE, DIM_ARTIST_TABLE, DIM_USER_TABLE, FACT_SONGPLAY_TABLE, DIM_TIME_TABLE]:
+        bump_table_version(table)
+
 
 def main(drop_cluster=False):
     """
     Main flow:
-        1. create Redshift cluster and database
+        1. create Redshift cluster and database, sized for the s3 input
         2. load staging data into a STAG schema
         3. insert from STAG tables into the Star schema in the DATA schema
+        4. profile the Star schema against the previous run
+        5. drop the cluster, or resize it back down to the configured size
 
     :param drop_cluster: whether to drop the Redshift cluster after we are done
     :return:
@@ -131,6 +139,7 @@ def main(drop_cluster=False):
 
     # get configs
     conn, configs = init_database()
+    cluster_dropped = False
 
     try:
         # load staging data from s3
@@ -140,17 +149,29 @@ def main(drop_cluster=False):
         insert_tables(conn=conn)
         print("Done")
 
+        # profile the star schema and compare with the previous run
+        profile_tables(conn)
+
         # perform some queries
         perform_queries(conn)
 
         # drop the cluster
         if drop_cluster:
             redshift_cluster_down(configs=configs)
+            cluster_dropped = True
 
     finally:
         if conn:
             conn.close()
 
+        # shrink a cluster we keep back to the configured size, also when a load step failed,
+        # without hiding the exception of that load step
+        if not cluster_dropped:
+            try:
+                scale_cluster_down(configs=configs)
+            except Exception as e:
+                print(f"Could not resize cluster back down: {e}")
+
 
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
@@ -1,19 +1,20 @@
+import fcntl
+import hashlib
+import json
+import math
+import os
+import re
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+
 from redshift_connector import Connection
 
 from sql_statements import *
 
 QUERIES = [
-    f"select count(*) from {FACT_SONGPLAY_TABLE} limit 5",
-    f"select count(*)  from {DIM_USER_TABLE} limit 5",
-    f"select count(*)  from {DIM_SONG_TABLE} limit 5",
-    f"select count(*)  from {DIM_ARTIST_TABLE} limit 5",
-    f"select count(*)  from {DIM_TIME_TABLE} limit 5",
-
-    f"select * from {FACT_SONGPLAY_TABLE} limit 5",
-    f"select * from {DIM_USER_TABLE} limit 5",
-    f"select * from {DIM_SONG_TABLE} limit 5",
-    f"select * from {DIM_ARTIST_TABLE} limit 5",
-    f"select * from {DIM_TIME_TABLE} limit 5",
     f"""select distinct  F.songplay_id, U.user_id, S.song_id, A.artist_id, T.time_id
      from {FACT_SONGPLAY_TABLE} F 
     join {DIM_USER_TABLE} U on U.user_id = F.user_id
@@ -24,22 +25,585 @@ QUERIES = [
     """
 ]
 
+# What to profile in each star schema table:
+#   key -- the (unenforced) primary key, checked for duplicates and distinct count
+#   columns -- other columns to measure null rates on
+#   foreign_keys -- column: (dimension table, dimension key) to count orphans for
+TABLE_PROFILES = {
+    FACT_SONGPLAY_TABLE: {
+        "key": "songplay_id",
+        "columns": ["time_id", "start_ts", "user_id", "level", "song_id", "artist_id", "session_id"],
+        "foreign_keys": {
+            "user_id": (DIM_USER_TABLE, "user_id"),
+            "song_id": (DIM_SONG_TABLE, "song_id"),
+            "artist_id": (DIM_ARTIST_TABLE, "artist_id"),
+            "time_id": (DIM_TIME_TABLE, "time_id"),
+        },
+    },
+    DIM_USER_TABLE: {"key": "user_id", "columns": ["first_name", "last_name", "gender", "level"]},
+    DIM_SONG_TABLE: {"key": "song_id", "columns": ["title", "artist_id", "year", "duration"]},
+    DIM_ARTIST_TABLE: {"key": "artist_id", "columns": ["name", "location", "latitude", "longitude"]},
+    DIM_TIME_TABLE: {"key": "time_id", "columns": ["hour", "day", "week", "month", "year", "weekday"]},
+}
+
+# Rates, distinct counts and orphans are measured on about this many rows per table,
+# so the cost of profiling does not grow with the fact table.
+# The sample is picked by a hash of the key, so every run (and every reference to it) sees the same rows
+PROFILE_SAMPLE_ROWS = 1000000
+
+# The profile of the previous run, to compare against
+PROFILE_FILE = "table_profile.json"
+
+# Warn when a null rate grows by more than this between runs
+NULL_RATE_TOLERANCE = 0.05
+
+# Warn when a distinct key estimate shrinks by more than this fraction between runs
+DISTINCT_TOLERANCE = 0.10
+
+# Query results are cached on local disk, keyed by the normalized sql and the load version
+# of every table it reads; etl bumps a table's version each time it (re)loads it
+CACHE_DIR = "query_cache"
+CACHE_INDEX_FILE = os.path.join(CACHE_DIR, "cache_index.json")
+TABLE_VERSIONS_FILE = os.path.join(CACHE_DIR, "table_versions.json")
+CACHE_LOCK_FILE = os.path.join(CACHE_DIR, "cache.lock")
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+CACHE_STATS = {"hits": 0, "misses": 0, "uncacheable": 0, "evictions": 0, "invalidations": 0}
+
+# A table, or a subquery, after from/join or a comma, with an optional alias and a trailing comma
+TABLE_ITEM = re.compile(r"""\s*(?:(?P<subquery>\()|(?P<name>[a-z_]\w*(?:\.[a-z_]\w*)?)\b)""")
+TABLE_ALIAS = re.compile(r"""(?:\s+as)?\s+(?!(?:where|join|left|right|inner|outer|full|cross|natural|on|using|group|order|limit|union|having|except|intersect|minus|offset)\b)[a-z_]\w*""")
+TABLE_COMMA = re.compile(r"\s*,")
+
+# Functions whose 'from' is not followed by a table, e.g. extract(hour from start_ts)
+FROM_FUNCTIONS = re.compile(r"\b(?:extract|trim|substring|position|overlay)\s*$")
+
+# Results that depend on when or how often a query runs, not only on the tables it reads
+VOLATILE_FUNCTIONS = re.compile(r"\b(?:getdate|sysdate|now|current_date|current_time|current_timestamp|"
+                                r"localtime|localtimestamp|timeofday|random|current_user|session_user|user)\b")
+
+# The table a write statement changes
+WRITTEN_TABLE = re.compile(r"(?:insert\s+into|update|delete\s+from|delete|truncate(?:\s+table)?|"
+                           r"drop\s+table(?:\s+if\s+exists)?|alter\s+table|copy)\s+([a-z_]\w*\.[a-z_]\w*)\b")
+
+# How cached result columns are stored: the type name in the file, how to write and how to read back a value
+COLUMN_TYPES = {
+    bool: ("bool", bool, bool),
+    int: ("int", int, int),
+    float: ("float", float, float),
+    str: ("str", str, str),
+    Decimal: ("decimal", str, Decimal),
+    datetime: ("datetime", datetime.isoformat, datetime.fromisoformat),
+    date: ("date", date.isoformat, date.fromisoformat),
+}
+COLUMN_DECODERS = {name: decode for name, encode, decode in COLUMN_TYPES.values()}
+
+
+def build_profile_query(table: str, profile: dict, row_count: int = 0) -> (str, list):
+    """
+    Build one query that measures everything we profile for a table in a single pass
+
+    :param table: the table to profile
+    :param profile: the entry for this table in TABLE_PROFILES
+    :param row_count: the rows in the table, to decide how much of it to sample
+    :return: the sql, and a (metric, column) pair for each column of its result
+    """
+    key = profile["key"]
+    foreign_keys = profile.get("foreign_keys", {})
+
+    selects = ["count(*)"]
+    metrics = [("sampled_rows", None)]
+
+    for column in [key] + profile["columns"]:
+        selects.append(f"sum(case when T.{column} is null then 1 else 0 end)")
+        metrics.append(("nulls", column))
+
+    for column in [key] + list(foreign_keys):
+        selects.append(f"approximate count(distinct T.{column})")
+        metrics.append(("distinct", column))
+
+    selects.append(f"count(*) - count(distinct T.{key})")
+    metrics.append(("duplicate_keys", key))
+
+    # orphans: semi-join each dimension to the keys of the sample only, so the distinct
+    # runs over at most PROFILE_SAMPLE_ROWS keys and not over the whole dimension
+    joins = []
+    for i, (column, (dim_table, dim_key)) in enumerate(foreign_keys.items()):
+        joins.append(f"left join (select distinct D.{dim_key} from {dim_table} D "
+                     f"where D.{dim_key} in (select {column} from T)) K{i} on K{i}.{dim_key} = T.{column}")
+        selects.append(f"sum(case when T.{column} is not null and K{i}.{dim_key} is null then 1 else 0 end)")
+        metrics.append(("orphans", column))
+
+    # keep one in sample_every rows, by key hash rather than limit, so the sample is the same each run
+    sample = f"select * from {table}"
+    sample_every = max(1, math.ceil(row_count / PROFILE_SAMPLE_ROWS))
+    if sample_every > 1:
+        sample += (f" where mod(strtol(substring(md5(coalesce({key}::varchar, '')), 1, 7), 16), {sample_every}) = 0")
+
+    sql = (f"with T as ({sample})\n"
+           f"select {', '.join(selects)}\n"
+           f"from T\n"
+           + "\n".join(joins))
+    return sql, metrics
+
+
+def get_row_counts(conn: Connection) -> dict:
+    """
+    Get the row count of every table in the DATA schema from the system catalog, without scanning them
+
+    :param conn: A live Redshift connection
+    :return: row count by table name, e.g. {"data.dim_user": 105}
+    """
+    cur = conn.cursor()
+    cur.execute(table_row_counts)
+    return {f"{DHW_SCHEMA}.{table}": int(row_count) for table, row_count in cur.fetchall()}
+
+
+def profile_table(conn: Connection, table: str, profile: dict, row_count: int = 0) -> dict:
+    """
+    Profile one table with a single combined query
+
+    :param conn: A live Redshift connection
+    :param table: the table to profile
+    :param profile: the entry for this table in TABLE_PROFILES
+    :param row_count: the rows in the table, from the system catalog
+    :return: the profile of the table
+    """
+    sql, metrics = build_profile_query(table, profile, row_count)
+    cur = conn.cursor()
+    cur.execute(sql)
+    row = cur.fetchone()
+
+    result = {"null_rate": {}, "distinct": {}, "orphans": {}}
+    sampled_rows = int(row[0])
+    result["sampled_rows"] = sampled_rows
+    for (metric, column), value in zip(metrics[1:], row[1:]):
+        value = int(value or 0)
+        if metric == "nulls":
+            result["null_rate"][column] = value / sampled_rows if sampled_rows else 0.0
+        elif metric == "duplicate_keys":
+            result["duplicate_keys"] = value
+        else:
+            result[metric][column] = value
+    return result
+
+
+def compare_profiles(previous: dict, current: dict) -> list:
+    """
+    Compare this run's profile with the previous run's
+
+    :param previous: the previous profile, by table
+    :param current: this run's profile, by table
+    :return: a list of warnings
+    """
+    warnings = []
+    for table, profile in current.items():
+        before = previous.get(table)
+        if before is None:
+            if profile["duplicate_keys"]:
+                warnings.append(f"{table}: {profile['duplicate_keys']} duplicate keys")
+            for column, orphans in profile["orphans"].items():
+                if orphans:
+                    warnings.append(f"{table}.{column}: {orphans} orphan keys")
+            continue
+
+        if profile["duplicate_keys"] > before["duplicate_keys"]:
+            warnings.append(f"{table}: duplicate keys went from {before['duplicate_keys']} "
+                            f"to {profile['duplicate_keys']}")
+
+        if profile["rows"] < before["rows"]:
+            warnings.append(f"{table}: rows dropped from {before['rows']} to {profile['rows']}")
+
+        for column, rate in profile["null_rate"].items():
+            before_rate = before["null_rate"].get(column, 0.0)
+            if rate - before_rate > NULL_RATE_TOLERANCE:
+                warnings.append(f"{table}.{column}: null rate went from {before_rate:.1%} to {rate:.1%}")
+
+        for column, distinct in profile["distinct"].items():
+            before_distinct = before["distinct"].get(column, 0)
+            if distinct < before_distinct * (1 - DISTINCT_TOLERANCE):
+                warnings.append(f"{table}.{column}: distinct keys went from {before_distinct} to {distinct}")
+
+        for column, orphans in profile["orphans"].items():
+            before_orphans = before["orphans"].get(column, 0)
+            if orphans > before_orphans:
+                warnings.append(f"{table}.{column}: orphan keys went from {before_orphans} to {orphans}")
+    return warnings
+
+
+def profile_tables(conn: Connection, profile_file: str = PROFILE_FILE) -> dict:
+    """
+    Profile every table in TABLE_PROFILES, compare with the previous run's profile and save this one.
+    Row counts come from the system catalog; everything else is one query per table.
+
+    :param conn: A live Redshift connection
+    :param profile_file: where the previous profile is read from and this one is written to
+    :return: this run's profile, by table
+    """
+    print("\nprofile tables ...")
+    row_counts = get_row_counts(conn)
+
+    current = {}
+    for table, profile in TABLE_PROFILES.items():
+        current[table] = profile_table(conn, table, profile, row_counts.get(table, 0))
+        current[table]["rows"] = row_counts.get(table, 0)
+        print(f"{table}: {json.dumps(current[table])}")
+
+    previous = {}
+    if os.path.exists(profile_file):
+        with open(profile_file) as f:
+            previous = json.load(f)
+
+    for warning in compare_profiles(previous, current):
+        print(f"WARNING {warning}")
+
+    with open(profile_file, "w") as f:
+        json.dump(current, f, indent=2)
+
+    return current
+
+
+def read_json(path: str) -> dict:
+    """
+    Read a json file, or return an empty dict if it does not exist yet
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_json(path: str, data: dict):
+    """
+    Write a json file in the cache directory, replacing it in one step
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def cache_lock():
+    """
+    Hold an exclusive lock on the cache while reading, changing and writing its json files,
+    so reporting processes sharing the cache directory do not lose each other's updates
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(CACHE_LOCK_FILE, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def normalize_sql(sql: str) -> str:
+    """
+    Lowercase and collapse the whitespace of a query, leaving its string literals alone,
+    so that the same query written differently gets the same cache key
+
+    :param sql: the query
+    :return: the normalized query
+    """
+    parts = re.split(r"('(?:[^']|'')*')", sql)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r"\s+", " ", parts[i]).lower()
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+def skip_parentheses(sql: str, pos: int) -> int:
+    """
+    Find the end of the parenthesized text that starts at sql[pos]
+
+    :param sql: the query, without string literals
+    :param pos: the position of the opening parenthesis
+    :return: the position just after the matching closing parenthesis, or -1 if there is none
+    """
+    depth = 0
+    for i in range(pos, len(sql)):
+        if sql[i] == "(":
+            depth += 1
+        elif sql[i] == ")":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return -1
+
+
+def in_from_function(sql: str, pos: int) -> bool:
+    """
+    Is sql[pos] inside the parentheses of a function that uses 'from', like extract(hour from start_ts)?
+
+    :param sql: the query, without string literals
+    :param pos: the position of a 'from' keyword
+    """
+    depth = 0
+    for i in range(pos - 1, -1, -1):
+        if sql[i] == ")":
+            depth += 1
+        elif sql[i] == "(":
+            if depth == 0:
+                return FROM_FUNCTIONS.search(sql, 0, i) is not None
+            depth -= 1
+    return False
+
+
+def referenced_tables(sql: str):
+    """
+    Find the schema qualified tables a normalized query reads from, including comma separated
+    from lists and subqueries.
+    If any table cannot be resolved -- quoted or unqualified names, or anything else after from/join
+    that we do not understand -- we cannot know when its result goes stale, so this returns None.
+
+    :param sql: the normalized query
+    :return: the sorted table names, e.g. ["data.dim_user", "data.fact_songplays"], or None
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", "''", sql)
+    cte_names = set(re.findall(r"(?:\bwith(?:\s+recursive)?|,)\s*([a-z_]\w*)\s+as\s*\(", sql))
+
+    tables = set()
+    for keyword in re.finditer(r"\b(?:from|join)\b", sql):
+        if in_from_function(sql, keyword.start()):
+            continue
+        pos = keyword.end()
+        while True:
+            item = TABLE_ITEM.match(sql, pos)
+            if item is None:
+                return None
+
+            if item.group("subquery"):
+                # the tables inside are found by their own from/join
+                pos = skip_parentheses(sql, item.start("subquery"))
+                if pos < 0:
+                    return None
+            else:
+                name = item.group("name")
+                if "." in name:
+                    tables.add(name)
+                elif name not in cte_names:
+                    return None
+                pos = item.end()
+
+            alias = TABLE_ALIAS.match(sql, pos)
+            if alias:
+                pos = alias.end()
+            comma = TABLE_COMMA.match(sql, pos)
+            if comma is None:
+                break
+            pos = comma.end()
+
+    return sorted(tables)
+
+
+def is_read(sql: str) -> bool:
+    """
+    Is this a plain read: a select, and no inserts, updates, ddl or select into
+
+    :param sql: the normalized query
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", "''", sql)
+    return re.match(r"(?:select|with)\b", sql) is not None and re.search(r"\binto\b", sql) is None
+
+
+def is_cacheable(sql: str) -> bool:
+    """
+    Only plain reads whose result depends on nothing but their tables can be served from the cache,
+    so no getdate(), random() and the like
+
+    :param sql: the normalized query
+    """
+    return is_read(sql) and VOLATILE_FUNCTIONS.search(re.sub(r"'(?:[^']|'')*'", "''", sql)) is None
+
+
+def bump_table_version(table: str):
+    """
+    Record that a table has been (re)loaded, and drop every cached result that read from it
+
+    :param table: the table that was loaded
+    """
+    table = table.lower()
+    with cache_lock():
+        versions = read_json(TABLE_VERSIONS_FILE)
+        versions[table] = time.time_ns()
+        write_json(TABLE_VERSIONS_FILE, versions)
+
+        index = read_json(CACHE_INDEX_FILE)
+        for key in [key for key, entry in index.items() if table in entry["tables"]]:
+            remove_cache_entry(index, key)
+            CACHE_STATS["invalidations"] += 1
+        write_json(CACHE_INDEX_FILE, index)
+
+
+def clear_cache():
+    """
+    Drop every cached result, for writes we cannot tell the table of
+    """
+    with cache_lock():
+        index = read_json(CACHE_INDEX_FILE)
+        for key in list(index):
+            remove_cache_entry(index, key)
+            CACHE_STATS["invalidations"] += 1
+        write_json(CACHE_INDEX_FILE, index)
+
+
+def remove_cache_entry(index: dict, key: str):
+    """
+    Remove a cached result from the index and from disk
+    """
+    index.pop(key, None)
+    path = os.path.join(CACHE_DIR, f"{key}.bin")
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def evict_cache_entries(index: dict):
+    """
+    Remove the least recently used results until the cache fits in CACHE_MAX_BYTES.
+    Sizes and last use (the modification time, touched on every hit) come from the result files
+    themselves, so files missing from the index still count and get evicted.
+    """
+    results = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith(".bin"):
+            stat = entry.stat()
+            results.append((stat.st_mtime_ns, stat.st_size, entry.name[:-len(".bin")]))
+
+    total_bytes = sum(size for last_used, size, key in results)
+    for last_used, size, key in sorted(results):
+        if total_bytes <= CACHE_MAX_BYTES:
+            break
+        total_bytes -= size
+        remove_cache_entry(index, key)
+        CACHE_STATS["evictions"] += 1
+
+
+def encode_result(rows: list) -> bytes:
+    """
+    Store a result column by column as compressed json: columns of one type compress far better than rows.
+    Every column gets one of the COLUMN_TYPES, so the result is read back without running any code.
+    Raises ValueError for a column with mixed or unsupported types.
+    """
+    columns = []
+    for column in zip(*rows):
+        value_types = {type(value) for value in column if value is not None}
+        if len(value_types) > 1 or not value_types <= COLUMN_TYPES.keys():
+            raise ValueError(f"cannot cache a column of {value_types}")
+        name, encode, decode = COLUMN_TYPES[value_types.pop()] if value_types else COLUMN_TYPES[str]
+        columns.append({"type": name, "values": [None if value is None else encode(value) for value in column]})
+    return zlib.compress(json.dumps({"row_count": len(rows), "columns": columns}).encode())
+
+
+def decode_result(data: bytes) -> list:
+    """
+    Turn a result stored by encode_result() back into rows
+    """
+    result = json.loads(zlib.decompress(data))
+    if not result["columns"]:
+        return [[] for _ in range(result["row_count"])]
+    columns = []
+    for column in result["columns"]:
+        decode = COLUMN_DECODERS[column["type"]]
+        columns.append([None if value is None else decode(value) for value in column["values"]])
+    return [list(row) for row in zip(*columns)]
+
+
+def cached_query(conn: Connection, query: str) -> list:
+    """
+    Run a query, or serve it from the local result cache if none of the tables it reads
+    have been reloaded since it was cached.
+    Queries that read a table etl has never loaded (system tables, unqualified or quoted names)
+    or call volatile functions always run. Writes run and invalidate the cached results of the
+    table they write, or of every table if we cannot tell which one that is.
+
+    :param conn: A live Redshift connection
+    :param query: the query
+    :return: the result rows
+    """
+    sql = normalize_sql(query)
+    if not is_read(sql):
+        cur = conn.cursor()
+        cur.execute(query)
+        written = WRITTEN_TABLE.match(re.sub(r"'(?:[^']|'')*'", "''", sql))
+        if written:
+            bump_table_version(written.group(1))
+        else:
+            clear_cache()
+        return [list(row) for row in cur.fetchall()] if cur.description else []
+
+    tables = referenced_tables(sql) if is_cacheable(sql) else None
+    versions = read_json(TABLE_VERSIONS_FILE)
+    if not tables or any(table not in versions for table in tables):
+        CACHE_STATS["uncacheable"] += 1
+        cur = conn.cursor()
+        cur.execute(query)
+        return [list(row) for row in cur.fetchall()]
+
+    # the key changes with the version of every table read, so a hit is never stale
+    stamp = json.dumps({table: versions[table] for table in tables})
+    key = hashlib.sha256(f"{sql}\n{stamp}".encode()).hexdigest()
+    path = os.path.join(CACHE_DIR, f"{key}.bin")
+
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)
+        CACHE_STATS["hits"] += 1
+        return decode_result(data)
+    except FileNotFoundError:
+        pass
+
+    CACHE_STATS["misses"] += 1
+    cur = conn.cursor()
+    cur.execute(query)
+    rows = [list(row) for row in cur.fetchall()]
+
+    try:
+        data = encode_result(rows)
+    except ValueError as e:
+        print(e)
+        return rows
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+    with cache_lock():
+        index = read_json(CACHE_INDEX_FILE)
+        index[key] = {"tables": tables}
+        evict_cache_entries(index)
+        write_json(CACHE_INDEX_FILE, index)
+    return rows
+
+
+def cache_stats() -> dict:
+    """
+    Result cache hit/miss metrics for this process
+
+    :return: the counters in CACHE_STATS plus the hit rate of the cacheable queries
+    """
+    stats = dict(CACHE_STATS)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
 
 def perform_queries(conn: Connection):
     """
-    Perform all queries in the global List "QUERIES"
+    Perform all queries in the global List "QUERIES", through the result cache
 
     :param conn: A live Redshift connection
     :return:
     """
-    cur = conn.cursor()
     print("\nquery tables ...")
     for query in QUERIES:
-        cur.execute(query)
+        results = cached_query(conn, query)
         print("\n----------------")
         print(query)
         print("----------------")
-        results = cur.fetchall()
         for row in results:
             print(row)
-
+    print(f"\nquery cache: {cache_stats()}")
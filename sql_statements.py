@@ -163,6 +163,20 @@ select
   case when DATE_PART(dayofweek,start_ts) in (0,6) then true else false end as is_weekday
 from {FACT_SONGPLAY_TABLE}"""
 
+# PROFILING
+# row counts from the catalog instead of scanning
+table_row_counts = f"""
+select "table", estimated_visible_rows from svv_table_info where "schema" = '{DHW_SCHEMA}'"""
+
+all_tables = [STAGING_LOGS_TABLE,
+              STAGING_SONG_TABLE,
+              FACT_SONGPLAY_TABLE,
+              DIM_USER_TABLE,
+              DIM_SONG_TABLE,
+              DIM_ARTIST_TABLE,
+              DIM_TIME_TABLE
+              ]
+
 drop_table_queries = [drop_stage_logs,
                       drop_stage_songs,
                       songplay_table_drop,
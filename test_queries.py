@@ -0,0 +1,193 @@
+import os
+import time
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+pytest.importorskip("redshift_connector")
+
+import queries
+
+
+class FakeConnection:
+    """
+    Stands in for a Redshift connection: counts executed queries and returns fixed rows
+    """
+    description = [("column",)]
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, query):
+        self.executed += 1
+
+    def fetchall(self):
+        return self.rows
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(queries, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(queries, "CACHE_INDEX_FILE", str(tmp_path / "cache_index.json"))
+    monkeypatch.setattr(queries, "TABLE_VERSIONS_FILE", str(tmp_path / "table_versions.json"))
+    monkeypatch.setattr(queries, "CACHE_LOCK_FILE", str(tmp_path / "cache.lock"))
+    monkeypatch.setattr(queries, "CACHE_STATS", dict.fromkeys(queries.CACHE_STATS, 0))
+    for table in queries.all_tables:
+        queries.bump_table_version(table)
+
+
+def tables_of(query):
+    return queries.referenced_tables(queries.normalize_sql(query))
+
+
+def test_referenced_tables_comma_join():
+    assert tables_of("select * from data.fact_songplays f, data.dim_user u where f.user_id = u.user_id") == \
+        ["data.dim_user", "data.fact_songplays"]
+
+
+def test_referenced_tables_comma_join_after_subquery():
+    assert tables_of("select * from (select user_id from data.dim_user) u, data.dim_time t") == \
+        ["data.dim_time", "data.dim_user"]
+
+
+def test_referenced_tables_skips_from_in_functions():
+    assert tables_of("select extract(hour from t.start_ts) from data.dim_time t") == ["data.dim_time"]
+    assert tables_of("select substring(title from 1 for 3), trim(both ' ' from title) from data.dim_song") == \
+        ["data.dim_song"]
+
+
+def test_referenced_tables_unresolved():
+    assert tables_of("select * from data.fact_songplays f, dim_user u") is None
+    assert tables_of('select * from "data"."dim_user"') is None
+
+
+def test_comma_join_invalidated_by_either_table():
+    conn = FakeConnection([[1, "a"]])
+    query = "select f.songplay_id, u.first_name from data.fact_songplays f, data.dim_user u"
+    queries.cached_query(conn, query)
+    queries.cached_query(conn, query)
+    assert conn.executed == 1
+
+    queries.bump_table_version("data.dim_user")
+    queries.cached_query(conn, query)
+    assert conn.executed == 2
+
+
+def test_writes_are_not_cached():
+    conn = FakeConnection([])
+    query = "insert into data.dim_user select * from data.fact_songplays"
+    queries.cached_query(conn, query)
+    queries.cached_query(conn, query)
+    assert conn.executed == 2
+
+
+def test_read_after_write_goes_to_the_database():
+    conn = FakeConnection([[1]])
+    read = "select count(*) from data.dim_user"
+    queries.cached_query(conn, read)
+    queries.cached_query(conn, read)
+    assert conn.executed == 1
+
+    queries.cached_query(conn, "delete from data.dim_user where user_id = 1")
+    queries.cached_query(conn, read)
+    assert conn.executed == 3
+
+
+def test_volatile_functions_are_not_cached():
+    for query in ["select count(*) from data.fact_songplays where start_ts > getdate() - interval '1 day'",
+                  "select * from data.dim_user order by random() limit 5",
+                  "select current_date, count(*) from data.dim_time"]:
+        assert not queries.is_cacheable(queries.normalize_sql(query))
+    assert queries.is_cacheable(queries.normalize_sql("select 'getdate()' from data.dim_time"))
+
+    conn = FakeConnection([[1]])
+    queries.cached_query(conn, "select sysdate from data.dim_time")
+    queries.cached_query(conn, "select sysdate from data.dim_time")
+    assert conn.executed == 2
+
+
+def test_cache_stats():
+    conn = FakeConnection([[1]])
+    queries.cached_query(conn, "select * from data.dim_user")
+    queries.cached_query(conn, "select * from data.dim_user")
+    queries.cached_query(conn, "select * from data.dim_user")
+    queries.cached_query(conn, "select * from pg_user")
+    stats = queries.cache_stats()
+    assert (stats["hits"], stats["misses"], stats["uncacheable"]) == (2, 1, 1)
+    assert stats["hit_rate"] == pytest.approx(2 / 3)
+
+
+def test_lru_eviction(monkeypatch):
+    conn = FakeConnection([[1, "a"]])
+    first, second, third = [f"select * from data.dim_user where user_id = {i}" for i in range(3)]
+    queries.cached_query(conn, first)
+    time.sleep(0.01)
+    queries.cached_query(conn, second)
+    time.sleep(0.01)
+    queries.cached_query(conn, first)  # hit: first is now the most recently used
+    result_size = max(entry.stat().st_size for entry in os.scandir(queries.CACHE_DIR) if entry.name.endswith(".bin"))
+    monkeypatch.setattr(queries, "CACHE_MAX_BYTES", result_size * 2)
+
+    time.sleep(0.01)
+    queries.cached_query(conn, third)
+    assert queries.cache_stats()["evictions"] == 1
+    assert conn.executed == 3
+
+    queries.cached_query(conn, first)
+    assert conn.executed == 3
+    queries.cached_query(conn, second)
+    assert conn.executed == 4
+
+
+def test_result_round_trip():
+    rows = [[1, "a", datetime(2018, 11, 2, 10, 33, 11), Decimal("190"), 1.5, True],
+            [2, None, None, None, None, False]]
+    assert queries.decode_result(queries.encode_result(rows)) == rows
+
+
+def test_profile_query_metric_order():
+    profile = {"key": "id", "columns": ["a"], "foreign_keys": {"fk": ("data.dim", "dim_id")}}
+    sql, metrics = queries.build_profile_query("data.t", profile)
+    assert metrics == [("sampled_rows", None),
+                       ("nulls", "id"), ("nulls", "a"),
+                       ("distinct", "id"), ("distinct", "fk"),
+                       ("duplicate_keys", "id"),
+                       ("orphans", "fk")]
+    assert sql.startswith("with T as (select * from data.t)\n")
+
+
+def test_profile_query_samples_by_key_hash():
+    profile = {"key": "id", "columns": []}
+    sql, metrics = queries.build_profile_query("data.t", profile, row_count=queries.PROFILE_SAMPLE_ROWS * 3)
+    assert "limit" not in sql
+    assert "md5(coalesce(id::varchar, '')), 1, 7), 16), 3) = 0" in sql
+
+
+def make_profile(rows=10, duplicate_keys=0, null_rate=0.0, distinct=100, orphans=0):
+    return {"rows": rows, "duplicate_keys": duplicate_keys, "null_rate": {"a": null_rate},
+            "distinct": {"id": distinct}, "orphans": {"fk": orphans}}
+
+
+def test_compare_profiles_unchanged():
+    assert queries.compare_profiles({"t": make_profile()}, {"t": make_profile()}) == []
+
+
+def test_compare_profiles_first_run():
+    warnings = queries.compare_profiles({}, {"t": make_profile(duplicate_keys=2, orphans=3)})
+    assert warnings == ["t: 2 duplicate keys", "t.fk: 3 orphan keys"]
+
+
+@pytest.mark.parametrize("current, warning", [
+    (make_profile(duplicate_keys=1), "t: duplicate keys went from 0 to 1"),
+    (make_profile(rows=5), "t: rows dropped from 10 to 5"),
+    (make_profile(null_rate=0.5), "t.a: null rate went from 0.0% to 50.0%"),
+    (make_profile(distinct=80), "t.id: distinct keys went from 100 to 80"),
+    (make_profile(orphans=1), "t.fk: orphan keys went from 0 to 1"),
+])
+def test_compare_profiles_rules(current, warning):
+    assert queries.compare_profiles({"t": make_profile()}, {"t": current}) == [warning]